@@ -29,6 +29,8 @@ class DiTConfig(PreTrainedConfig):
     vision_backbone_norm_name: str = "group_norm"
     vision_backbone_norm_num_groups: int = 16
     use_separate_rgb_encoder_per_camera = True
+    # Statically quantize the vision backbone(s) to int8 in `DiTPolicy.convert_for_inference` (CPU only).
+    quantize_vision_backbone: bool = False
 
     # for spatial softmax resnet encoder
     use_spatial_softmax:bool = False
@@ -46,6 +48,13 @@ class DiTConfig(PreTrainedConfig):
     feedforward_activation: str = "gelu"
     n_encoder_layers: int = 6
     n_decoder_layers: int = 6
+    # Condition the final layer on the last encoder token averaged over the batch (plus the timestep
+    # embedding) rather than on the per-sample conditioning vector of the decoder layers. This mixes the
+    # samples of a batch, but it is what existing checkpoints were trained with.
+    # Checkpoints trained with one setting give different outputs with the other.
+    legacy_final_layer_cond: bool = True
+    # Compile each encoder/decoder layer with `torch.compile`. All layers share the same compiled artifact.
+    use_torch_compile: bool = False
 
     # Diffusion Timestep Encoder
     time_dim = 256
@@ -63,6 +72,10 @@ class DiTConfig(PreTrainedConfig):
 
     # Inference.
     num_inference_steps: int | None = 10
+    # Use precomputed per-step coefficients instead of calling `noise_scheduler.step` in the denoising loop.
+    fast_step: bool = True
+    # Capture the denoising network in a CUDA graph and replay it at every denoising step (CUDA, eval only).
+    use_cuda_graph: bool = False
 
     # Training presets
     optimizer_lr: float = 1e-4
@@ -1,14 +1,15 @@
 import math
 from collections import deque
-from typing import Callable
+from contextlib import nullcontext
+from typing import Callable, Iterable
 
-import einops
 import numpy as np
 import torch
 import torch.nn.functional as F  # noqa: N812
 import torchvision
 from diffusers.schedulers.scheduling_ddim import DDIMScheduler
 from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from diffusers.utils.torch_utils import randn_tensor
 from torch import Tensor, nn
 
 from lerobot.common.constants import OBS_ENV, OBS_ROBOT
@@ -22,6 +23,7 @@ from lerobot.common.policies.utils import (
     populate_queues,
 )
 
+
 class DiTPolicy(PreTrainedPolicy):
     """
     DiT Policy as per "The Ingredients for Robotic Diffusion Transformers"
@@ -65,6 +67,67 @@ class DiTPolicy(PreTrainedPolicy):
     def get_optim_params(self) -> dict:
         return self.diffusion.parameters()
 
+    def convert_for_inference(
+        self, calibration_batches: Iterable[dict[str, Tensor]] | None = None
+    ) -> "DiTPolicy":
+        """Optimize the vision backbone(s) for deployment.
+
+        This should be called once the weights are loaded and the policy is on its final device. The converted
+        policy is meant for rollouts only: it should neither be trained nor saved afterwards.
+          - On CUDA, the RGB encoders are switched to the channels-last memory format, which is what the
+            tensor core convolution kernels expect.
+          - On CPU, if `config.quantize_vision_backbone` is set, the ResNet(s) are statically quantized to
+            int8 (post-training quantization with FX graph mode). `calibration_batches` is then required:
+            it is used to record the activation ranges, and should be a few batches of observations in the
+            format expected by `forward` (e.g. from the training dataset).
+        """
+        if not self.config.image_features:
+            return self
+        self.eval()
+        device = get_device_from_parameters(self)
+        if device.type == "cuda":
+            self.diffusion.rgb_encoder.to(memory_format=torch.channels_last)
+        if not self.config.quantize_vision_backbone:
+            return self
+
+        if device.type != "cpu":
+            raise ValueError(f"Quantizing the vision backbone is only supported on CPU. Got {device.type}.")
+        if calibration_batches is None:
+            raise ValueError("`calibration_batches` must be provided to quantize the vision backbone.")
+        from torch.ao.quantization import get_default_qconfig_mapping
+        from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+        if self.config.use_separate_rgb_encoder_per_camera:
+            encoders = list(self.diffusion.rgb_encoder)
+        else:
+            encoders = [self.diffusion.rgb_encoder]
+        image_shape = next(iter(self.config.image_features.values())).shape
+        if self.config.use_spatial_softmax:
+            # The spatial softmax encoders keep their ResNet in `backbone` and (maybe) crop its input.
+            backbone_name = "backbone"
+            if self.config.crop_shape is not None:
+                image_shape = (image_shape[0], *self.config.crop_shape)
+        else:
+            backbone_name = "_model"
+        example_inputs = (torch.zeros(1, *image_shape),)
+        qconfig_mapping = get_default_qconfig_mapping("x86")
+        for encoder in encoders:
+            backbone = prepare_fx(getattr(encoder, backbone_name), qconfig_mapping, example_inputs)
+            setattr(encoder, backbone_name, backbone)
+        # Run the observation encoders on the calibration batches so that the observers record the ranges of
+        # the activations.
+        with torch.no_grad():
+            for batch in calibration_batches:
+                batch = self.normalize_inputs(batch)
+                batch = dict(batch)
+                batch["observation.images"] = torch.stack(
+                    [batch[key] for key in self.config.image_features], dim=-4
+                )
+                self.diffusion._prepare_global_conditioning(batch)
+        for encoder in encoders:
+            setattr(encoder, backbone_name, convert_fx(getattr(encoder, backbone_name)))
+        return self
+
     def reset(self):
         """Clear observation and action queues. Should be called on `env.reset()`"""
         self._queues = {
@@ -76,7 +139,7 @@ class DiTPolicy(PreTrainedPolicy):
         if self.config.env_state_feature:
             self._queues["observation.environment_state"] = deque(maxlen=self.config.n_obs_steps)
 
-    @torch.no_grad
+    @torch.inference_mode()
     def select_action(self, batch: dict[str, Tensor]) -> Tensor:
         """Select a single action given environment observations.
 
@@ -107,6 +170,8 @@ class DiTPolicy(PreTrainedPolicy):
         # Note: It's important that this happens after stacking the images into a single key.
         self._queues = populate_queues(self._queues, batch)
 
+        # The observation encoders and the diffusion model only run when the action queue runs dry. In
+        # between, actions are served from the queue.
         if len(self._queues["action"]) == 0:
             # stack n latest observations from the queue
             batch = {k: torch.stack(list(self._queues[k]), dim=1) for k in batch if k in self._queues}
@@ -144,7 +209,82 @@ def _make_noise_scheduler(name: str, **kwargs: dict) -> DDPMScheduler | DDIMSche
         return DDIMScheduler(**kwargs)
     else:
         raise ValueError(f"Unsupported noise scheduler type {name}")
-    
+
+
+def _make_fast_step(
+    scheduler: DDPMScheduler | DDIMScheduler, device: torch.device, dtype: torch.dtype
+) -> Callable[[Tensor, int, Tensor, torch.Generator | None], Tensor]:
+    """
+    Precompute the per-step coefficients of `scheduler.step` for the current `scheduler.timesteps` (so this
+    must be called after `set_timesteps`). The returned function `step(model_output, i, sample, generator)`
+    computes the same update as `scheduler.step(model_output, scheduler.timesteps[i], sample, generator)`
+    for DDIM (with eta=0) and DDPM ("fixed_small" variance), but only indexes a coefficient table by the loop
+    position `i` instead of re-deriving the coefficients from the alphas on the host at every step.
+    """
+    config = scheduler.config
+    is_ddim = isinstance(scheduler, DDIMScheduler)
+    step_ratio = config.num_train_timesteps // scheduler.num_inference_steps
+    alphas_cumprod = scheduler.alphas_cumprod.double()
+    final_alpha_cumprod = float(scheduler.final_alpha_cumprod) if is_ddim else 1.0
+
+    # Each step is written as:
+    #   x_0 = clip(c0 * sample + c1 * model_output)
+    #   prev_sample = c2 * x_0 + c3 * sample + c4 * model_output + c5 * noise
+    coeffs = []
+    for t in scheduler.timesteps.tolist():
+        prev_t = t - step_ratio
+        alpha_prod_t = alphas_cumprod[t].item()
+        alpha_prod_t_prev = alphas_cumprod[prev_t].item() if prev_t >= 0 else final_alpha_cumprod
+        beta_prod_t = 1 - alpha_prod_t
+        beta_prod_t_prev = 1 - alpha_prod_t_prev
+
+        # Predicted x_0 and epsilon (before clipping) as linear combinations of sample and model_output.
+        if config.prediction_type == "epsilon":
+            x0_coeffs = (1 / alpha_prod_t**0.5, -(beta_prod_t**0.5) / alpha_prod_t**0.5)
+            eps_coeffs = (0.0, 1.0)
+        elif config.prediction_type == "sample":
+            x0_coeffs = (0.0, 1.0)
+            eps_coeffs = (1 / beta_prod_t**0.5, -(alpha_prod_t**0.5) / beta_prod_t**0.5)
+        else:
+            raise ValueError(f"Unsupported prediction type {config.prediction_type}")
+
+        if is_ddim:
+            # x_t-1 = sqrt(alpha_prod_t_prev) * x_0 + sqrt(1 - alpha_prod_t_prev) * epsilon
+            x0_coeff = alpha_prod_t_prev**0.5
+            sample_coeff = beta_prod_t_prev**0.5 * eps_coeffs[0]
+            output_coeff = beta_prod_t_prev**0.5 * eps_coeffs[1]
+            noise_std = 0.0
+        else:
+            # Formula (7) from https://arxiv.org/pdf/2006.11239.pdf
+            current_alpha_t = alpha_prod_t / alpha_prod_t_prev
+            current_beta_t = 1 - current_alpha_t
+            x0_coeff = alpha_prod_t_prev**0.5 * current_beta_t / beta_prod_t
+            sample_coeff = current_alpha_t**0.5 * beta_prod_t_prev / beta_prod_t
+            output_coeff = 0.0
+            noise_std = max(beta_prod_t_prev / beta_prod_t * current_beta_t, 1e-20) ** 0.5 if t > 0 else 0.0
+        coeffs.append((*x0_coeffs, x0_coeff, sample_coeff, output_coeff, noise_std))
+    add_noise = [row[5] > 0 for row in coeffs]
+    coeffs = torch.tensor(coeffs, dtype=dtype, device=device)
+
+    def step(
+        model_output: Tensor, i: int, sample: Tensor, generator: torch.Generator | None = None
+    ) -> Tensor:
+        c = coeffs[i]
+        pred_original_sample = c[0] * sample + c[1] * model_output
+        if config.clip_sample:
+            clip_range = config.clip_sample_range
+            pred_original_sample = pred_original_sample.clamp(-clip_range, clip_range)
+        prev_sample = c[2] * pred_original_sample + c[3] * sample + c[4] * model_output
+        if add_noise[i]:
+            noise = randn_tensor(
+                model_output.shape, generator=generator, device=device, dtype=model_output.dtype
+            )
+            prev_sample = prev_sample + c[5] * noise
+        return prev_sample
+
+    return step
+
+
 class DiT(nn.Module):
     def __init__(self, config: DiTConfig):
         super().__init__()
@@ -192,10 +332,29 @@ class DiT(nn.Module):
         else:
             self.num_inference_steps = config.num_inference_steps
 
+        # CUDA graphs of `noise_net.forward_dec`, keyed by (padded batch size, dtype, device index). See
+        # `_get_graphed_denoiser`.
+        self._graph_pool = {}
+        # Memory pool shared by all the CUDA graphs captured on a device, keyed by device index.
+        self._graph_mempools = {}
+        # Step functions of `_make_fast_step`, keyed by (num_inference_steps, device, dtype).
+        self._fast_steps = {}
+        # Side streams for the per-camera RGB encoders, keyed by device. See `_encode_images_per_camera`.
+        self._camera_streams = {}
+
     # ========= inference  ============
     def conditional_sample(
-        self, batch_size: int, global_cond: Tensor | None = None, generator: torch.Generator | None = None
+        self,
+        batch_size: int,
+        global_cond: Tensor | None = None,
+        generator: torch.Generator | None = None,
+        enc_cache: Tensor | None = None,
     ) -> Tensor:
+        """Run the reverse diffusion process.
+
+        If `enc_cache` (the output of `noise_net.forward_enc`) is provided, `global_cond` is ignored and the
+        encoder is not run again.
+        """
         device = get_device_from_parameters(self)
         dtype = get_dtype_from_parameters(self)
 
@@ -209,20 +368,119 @@ class DiT(nn.Module):
 
         self.noise_scheduler.set_timesteps(self.num_inference_steps)
 
-        enc_cache = self.noise_net.forward_enc(global_cond)
+        if self.config.fast_step:
+            key = (self.num_inference_steps, device, dtype)
+            if key not in self._fast_steps:
+                self._fast_steps[key] = _make_fast_step(self.noise_scheduler, device, dtype)
+            fast_step = self._fast_steps[key]
 
-        for t in self.noise_scheduler.timesteps:
-            # Predict model output.
-            model_output = self.noise_net.forward_dec(
-                sample, 
-                torch.full(sample.shape[:1], t, dtype=torch.long, device=sample.device),
-                enc_cache
-            )
-            # Compute previous image: x_t -> x_t-1
-            sample = self.noise_scheduler.step(model_output, t, sample, generator=generator).prev_sample
+        with self._autocast(device):
+            if enc_cache is None:
+                enc_cache = self.noise_net.forward_enc(global_cond)
+
+            # The timesteps are fixed by `set_timesteps`, so all their embeddings are computed in one batch up
+            # front rather than running the time network at every step.
+            time_table = self.noise_net.time_net(self.noise_scheduler.timesteps.to(device))
+
+            if self.config.use_cuda_graph and device.type == "cuda" and not self.training:
+                denoise = self._get_graphed_denoiser(sample, time_table[0], enc_cache)
+            else:
+                denoise = self.noise_net.forward_dec
+
+            for i, t in enumerate(self.noise_scheduler.timesteps):
+                # Predict model output.
+                model_output = denoise(sample, None, enc_cache, time_enc=time_table[i])
+                # Compute previous image: x_t -> x_t-1. The scheduler runs in full precision as it accumulates
+                # error over the steps.
+                model_output = model_output.to(sample.dtype)
+                if self.config.fast_step:
+                    sample = fast_step(model_output, i, sample, generator=generator)
+                else:
+                    sample = self.noise_scheduler.step(
+                        model_output, t, sample, generator=generator
+                    ).prev_sample
 
         return sample
 
+    def _apply(self, fn, *args, **kwargs):
+        # The captured CUDA graphs read the parameters from their current storage, so they are dropped when
+        # the parameters are moved or cast.
+        self._graph_pool.clear()
+        self._graph_mempools.clear()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _autocast(self, device: torch.device):
+        """Mixed precision context for the transformer and vision backbone, enabled by `config.use_amp`.
+
+        Only applies on CUDA, with bfloat16 where supported and float16 otherwise. When the denoiser runs as a
+        CUDA graph (`config.use_cuda_graph`, eval only), the autocast weight cache is disabled as cached casts
+        would not outlive the context while the captured graph uses them.
+        """
+        if not self.config.use_amp or device.type != "cuda":
+            return nullcontext()
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        # `None` keeps the default (or the enclosing context's) caching behavior.
+        cache_enabled = False if self.config.use_cuda_graph and not self.training else None
+        return torch.autocast(device_type="cuda", dtype=dtype, cache_enabled=cache_enabled)
+
+    def _get_graphed_denoiser(self, sample: Tensor, time_enc: Tensor, enc_cache: Tensor) -> Callable:
+        """Return a drop-in replacement for `noise_net.forward_dec` (called with a precomputed `time_enc`)
+        that replays a captured CUDA graph.
+
+        Graphs are captured on static input buffers and pooled by (padded batch size, dtype, device index).
+        The batch size is padded up to the next power of two so that varying batch sizes (e.g. during eval)
+        reuse a handful of graphs; the padding rows are ignored as every sample is denoised independently.
+        With `config.legacy_final_layer_cond` the final layer averages over the batch, so the padding rows
+        would change the output: the batch is then not padded.
+
+        The returned callable copies its inputs into the static buffers and replays the graph, so its output
+        is only valid until the next call. The scheduler step is kept out of the graph as it relies on
+        Python-side branching.
+        """
+        batch_size = sample.shape[0]
+        if self.config.legacy_final_layer_cond:
+            padded_batch_size = batch_size
+        else:
+            padded_batch_size = 1 << (batch_size - 1).bit_length()
+        key = (padded_batch_size, sample.dtype, sample.device.index)
+        if key not in self._graph_pool:
+            # Capture outside of inference mode (which `select_action` runs in) so that the static buffers are
+            # regular tensors and the graph can also be replayed from plain `no_grad` code.
+            with torch.inference_mode(False), torch.no_grad():
+                static_sample = sample.new_zeros((padded_batch_size, *sample.shape[1:]))
+                static_time_enc = torch.zeros_like(time_enc)
+                static_enc_cache = enc_cache.new_zeros((padded_batch_size, *enc_cache.shape[1:]))
+                # Warm up on a side stream so that lazy initializations don't end up in the graph.
+                stream = torch.cuda.Stream()
+                stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(stream):
+                    for _ in range(3):
+                        self.noise_net.forward_dec(
+                            static_sample, None, static_enc_cache, time_enc=static_time_enc
+                        )
+                torch.cuda.current_stream().wait_stream(stream)
+
+                # All the graphs share one memory pool. This is safe as they are never replayed concurrently,
+                # and their outputs (the only allocations that outlive a replay) are kept alive in the pool.
+                mempool = self._graph_mempools.setdefault(sample.device.index, torch.cuda.graph_pool_handle())
+                graph = torch.cuda.CUDAGraph()
+                with torch.cuda.graph(graph, pool=mempool):
+                    static_out = self.noise_net.forward_dec(
+                        static_sample, None, static_enc_cache, time_enc=static_time_enc
+                    )
+            self._graph_pool[key] = (graph, static_sample, static_time_enc, static_enc_cache, static_out)
+
+        graph, static_sample, static_time_enc, static_enc_cache, static_out = self._graph_pool[key]
+        static_enc_cache[:batch_size].copy_(enc_cache)
+
+        def denoise(sample: Tensor, time: None, enc_cache: Tensor, time_enc: Tensor) -> Tensor:
+            static_sample[:batch_size].copy_(sample)
+            static_time_enc.copy_(time_enc)
+            graph.replay()
+            return static_out[:batch_size]
+
+        return denoise
+
     def _prepare_global_conditioning(self, batch: dict[str, Tensor]) -> Tensor:
         """Encode robot state features and image features, and concatenate them all together along with the state vector."""
         batch_size, n_obs_steps = batch[OBS_ROBOT].shape[:2]
@@ -230,29 +488,19 @@ class DiT(nn.Module):
         # Extract image features.
         if self.config.image_features:
             if self.config.use_separate_rgb_encoder_per_camera:
-                # Combine batch and sequence dims while rearranging to make the camera index dimension first.
-                images_per_camera = einops.rearrange(batch["observation.images"], "b s n ... -> n (b s) ...")
-                img_features_list = torch.cat(
-                    [
-                        encoder(images)
-                        for encoder, images in zip(self.rgb_encoder, images_per_camera, strict=True)
-                    ]
-                )
-                # Separate batch and sequence dims back out. The camera index dim gets absorbed into the
-                # feature dim (effectively concatenating the camera features).
-                img_features = einops.rearrange(
-                    img_features_list, "(n b s) ... -> b s (n ...)", b=batch_size, s=n_obs_steps
-                )
+                # Combine batch and sequence dims while making the camera index dimension first. This is a
+                # view: each camera's images are read in place by its encoder.
+                images_per_camera = batch["observation.images"].flatten(0, 1).transpose(0, 1)
+                img_features_list = self._encode_images_per_camera(images_per_camera)
+                # Concatenate the camera features along the first feature dim (the camera index dim gets
+                # absorbed into the feature dim) and separate batch and sequence dims back out.
+                img_features = torch.cat(img_features_list, dim=1).reshape(batch_size, n_obs_steps, -1)
             else:
                 # Combine batch, sequence, and "which camera" dims before passing to shared encoder.
-                img_features = self.rgb_encoder(
-                    einops.rearrange(batch["observation.images"], "b s n ... -> (b s n) ...")
-                )
+                img_features = self.rgb_encoder(batch["observation.images"].flatten(0, 2))
                 # Separate batch dim and sequence dim back out. The camera index dim gets absorbed into the
                 # feature dim (effectively concatenating the camera features).
-                img_features = einops.rearrange(
-                    img_features, "(b s n) ... -> b s (n ...)", b=batch_size, s=n_obs_steps
-                )
+                img_features = img_features.reshape(batch_size, n_obs_steps, -1)
             global_cond_feats.append(img_features)
         # Extract robot state features
         if self.config.robot_state_feature:
@@ -266,6 +514,34 @@ class DiT(nn.Module):
         # Concatenate features then flatten to (B, T, dim_model).
         return torch.cat(global_cond_feats, dim=1)
 
+    def _encode_images_per_camera(self, images_per_camera: Tensor) -> list[Tensor]:
+        """Run each camera's RGB encoder on its (B*S, C, H, W) images.
+
+        At inference time on CUDA, each encoder is dispatched on its own stream so that the kernels of the
+        different cameras can overlap instead of running back to back.
+        """
+        if not images_per_camera.is_cuda or torch.is_grad_enabled() or len(self.rgb_encoder) == 1:
+            return [
+                encoder(images) for encoder, images in zip(self.rgb_encoder, images_per_camera, strict=True)
+            ]
+
+        device = images_per_camera.device
+        if device not in self._camera_streams:
+            self._camera_streams[device] = [torch.cuda.Stream(device) for _ in self.rgb_encoder]
+        streams = self._camera_streams[device]
+
+        main_stream = torch.cuda.current_stream(device)
+        features = []
+        for encoder, images, stream in zip(self.rgb_encoder, images_per_camera, streams, strict=True):
+            stream.wait_stream(main_stream)
+            with torch.cuda.stream(stream):
+                features.append(encoder(images))
+        for feats, stream in zip(features, streams, strict=True):
+            main_stream.wait_stream(stream)
+            # The features were allocated on the side stream but are consumed on the main one.
+            feats.record_stream(main_stream)
+        return features
+
     def generate_actions(self, batch: dict[str, Tensor]) -> Tensor:
         """
         This function expects `batch` to have:
@@ -280,11 +556,14 @@ class DiT(nn.Module):
         batch_size, n_obs_steps = batch["observation.state"].shape[:2]
         assert n_obs_steps == self.config.n_obs_steps
 
-        # Encode image features and concatenate them all together along with the state vector.
-        global_cond = self._prepare_global_conditioning(batch)  # (B, global_cond_dim)
+        with self._autocast(get_device_from_parameters(self)):
+            # Encode image features and concatenate them all together along with the state vector.
+            global_cond = self._prepare_global_conditioning(batch)  # (B, global_cond_dim)
+            # The encoder output is shared by all the denoising steps, so it is computed once up front.
+            enc_cache = self.noise_net.forward_enc(global_cond)
 
         # run sampling
-        actions = self.conditional_sample(batch_size, global_cond=global_cond)
+        actions = self.conditional_sample(batch_size, enc_cache=enc_cache)
 
         # Extract `n_action_steps` steps worth of actions (from the current observation).
         start = n_obs_steps - 1
@@ -316,7 +595,8 @@ class DiT(nn.Module):
         assert n_obs_steps == self.config.n_obs_steps
 
         # Encode image features and concatenate them all together along with the state vector.
-        global_cond = self._prepare_global_conditioning(batch)  # (B, global_cond_dim)
+        with self._autocast(batch["action"].device):
+            global_cond = self._prepare_global_conditioning(batch)  # (B, global_cond_dim)
 
         # Forward diffusion.
         trajectory = batch["action"]
@@ -333,7 +613,8 @@ class DiT(nn.Module):
         noisy_trajectory = self.noise_scheduler.add_noise(trajectory, eps, timesteps)
 
         # Run the denoising network (that might denoise the trajectory, or attempt to predict the noise).
-        _, pred = self.noise_net(noisy_trajectory, timesteps, global_cond=global_cond)
+        with self._autocast(trajectory.device):
+            _, pred = self.noise_net(noisy_trajectory, timesteps, global_cond=global_cond)
 
         # Compute the loss.
         # The target is either the original trajectory, or the noise.
@@ -344,7 +625,7 @@ class DiT(nn.Module):
         else:
             raise ValueError(f"Unsupported prediction type {self.config.prediction_type}")
 
-        loss = F.mse_loss(pred, target, reduction="none")
+        loss = F.mse_loss(pred.to(target.dtype), target, reduction="none")
 
         # Mask loss wherever the action is padded with copies (edges of the dataset trajectory).
         # if self.config.do_mask_loss_for_padding:
@@ -373,12 +654,15 @@ class DiTNoiseNet(nn.Module):
         self.enc_pos = PositionalEncoding(config.dim_model)
         self.register_parameter(
             "dec_pos",
-            nn.Parameter(torch.empty(config.horizon, 1, config.dim_model), requires_grad=True),
+            nn.Parameter(torch.empty(1, config.horizon, config.dim_model), requires_grad=True),
         )
         nn.init.xavier_uniform_(self.dec_pos.data)
 
         # input encoder mlps
         self.time_net = TimeNetwork(config.time_dim, config.dim_model)
+        if config.use_torch_compile:
+            # Lets Inductor fuse the timestep scaling, sin/cos and the first linear layer.
+            self.time_net.compile(fullgraph=True, dynamic=True)
 
         action_dim = config.action_feature.shape[0]
 
@@ -409,26 +693,39 @@ class DiTNoiseNet(nn.Module):
         return enc_cache, self.forward_dec(noise_actions, time, enc_cache)
     
     def forward_enc(self, global_cond):
-        # reshape global condition from (B T dim_model) into (T B dim_model)
-        global_cond = einops.rearrange(global_cond, 'B T ... -> T B ...')
+        # all the tokens are kept batch first: (B T dim_model)
         pos = self.enc_pos(global_cond)
         enc_cache = self.encoder(global_cond, pos)
         return enc_cache
 
-    def forward_dec(self, noise_actions, time, enc_cache):
-        time_enc = self.time_net(time)
-        
-        ac_tokens = self.ac_proj(noise_actions)
-        # reshape actions embedding from (B T dim_model) into (T B dim_model)
-        ac_tokens = einops.rearrange(ac_tokens, 'B T ... -> T B ...')
-        dec_in = ac_tokens + self.dec_pos
+    def forward_dec(self, noise_actions, time, enc_cache, time_enc=None):
+        # `time_enc` can be passed instead of `time` when the timestep embedding has already been computed
+        if time_enc is None:
+            time_enc = self.time_net(time)
+
+        dec_in = self.ac_proj(noise_actions) + self.dec_pos
+
+        # the conditioning vector is shared by all the decoder layers
+        cond = torch.mean(enc_cache, axis=1) + time_enc
 
         # apply decoder
-        dec_out = self.decoder(dec_in, time_enc, enc_cache)
+        dec_out = self.decoder(dec_in, cond)
 
         # apply final epsilon prediction layer
-        output = self.eps_out(dec_out, time_enc, enc_cache[-1])
+        if self.config.legacy_final_layer_cond:
+            # conditioned on the last encoder token averaged over the batch
+            final_cond = (torch.mean(enc_cache[:, -1], axis=0) + time_enc).expand_as(cond)
+        else:
+            final_cond = cond
+        output = self.eps_out(dec_out, final_cond)
         return output
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints stored the decoder positional embedding as (horizon, 1, dim_model).
+        dec_pos = state_dict.get(prefix + "dec_pos")
+        if dec_pos is not None and dec_pos.shape[1] == 1 and dec_pos.shape[0] != 1:
+            state_dict[prefix + "dec_pos"] = dec_pos.transpose(0, 1)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
     
 
 class DiTEncoder(nn.Module):
@@ -439,6 +736,9 @@ class DiTEncoder(nn.Module):
         self.layers = nn.ModuleList([DiTEncoderLayer(config) for _ in range(num_layers)])
         for layer in self.layers:
             layer.reset_parameters()
+            if config.use_torch_compile:
+                # Compiled in place (rather than wrapped) so that state dict keys are unchanged.
+                layer.compile(fullgraph=True, dynamic=True)
     
     def forward(self, x: Tensor, pos_embed: Tensor | None = None) -> Tensor:
         for layer in self.layers:
@@ -451,7 +751,7 @@ class DiTEncoderLayer(nn.Module):
         self, config: DiTConfig
     ):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(config.dim_model, config.n_heads, dropout=config.dropout)
+        self.self_attn = DiTAttention(config.dim_model, config.n_heads, dropout=config.dropout)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(config.dim_model, config.dim_feedforward)
         self.linear2 = nn.Linear(config.dim_feedforward, config.dim_model)
@@ -466,8 +766,7 @@ class DiTEncoderLayer(nn.Module):
         self.activation = get_activation_fn(config.feedforward_activation)
 
     def forward(self, src, pos_embed):
-        q = k = with_pos_embed(src, pos_embed)
-        src2, _ = self.self_attn(q, k, value=src, need_weights=False)
+        src2 = self.self_attn(src, pos_embed=pos_embed)
         src = src + self.dropout1(src2)
         src = self.norm1(src)
         src2 = self.linear2(self.dropout2(self.activation(self.linear1(src))))
@@ -481,43 +780,57 @@ class DiTEncoderLayer(nn.Module):
                 nn.init.xavier_uniform_(p)
 
 
-class ShiftScaleMod(nn.Module):
-    def __init__(self, dim):
-        super().__init__()
-        self.act = nn.SiLU()
-        self.scale = nn.Linear(dim, dim)
-        self.shift = nn.Linear(dim, dim)
-
-    def forward(self, x, c):
-        c = self.act(c)
-        return x * self.scale(c)[None] + self.shift(c)[None]
-
-    def reset_parameters(self):
-        nn.init.xavier_uniform_(self.scale.weight)
-        nn.init.xavier_uniform_(self.shift.weight)
-        nn.init.zeros_(self.scale.bias)
-        nn.init.zeros_(self.shift.bias)
+class DiTAttention(nn.Module):
+    """Multi-head self-attention over (B, T, D) tokens, dispatched to `F.scaled_dot_product_attention`.
 
+    The q/k/v projections are fused into a single GEMM. Parameter names match `nn.MultiheadAttention` so that
+    existing checkpoints load unchanged.
+    """
 
-class ZeroScaleMod(nn.Module):
-    def __init__(self, dim):
+    def __init__(self, dim: int, n_heads: int, dropout: float = 0.0):
         super().__init__()
-        self.act = nn.SiLU()
-        self.scale = nn.Linear(dim, dim)
-
-    def forward(self, x, c):
-        c = self.act(c)
-        return x * self.scale(c)[None]
+        assert dim % n_heads == 0, "dim must be divisible by n_heads!"
+        self.n_heads = n_heads
+        self.dropout = dropout
+        self.in_proj_weight = nn.Parameter(torch.empty(3 * dim, dim))
+        self.in_proj_bias = nn.Parameter(torch.zeros(3 * dim))
+        self.out_proj = nn.Linear(dim, dim)
+        nn.init.xavier_uniform_(self.in_proj_weight)
+        nn.init.zeros_(self.out_proj.bias)
 
-    def reset_parameters(self):
-        nn.init.zeros_(self.scale.weight)
-        nn.init.zeros_(self.scale.bias)
+    def forward(self, x: Tensor, pos_embed: Tensor | None = None) -> Tensor:
+        batch_size, seq_len, dim = x.shape
+        if pos_embed is None:
+            q, k, v = F.linear(x, self.in_proj_weight, self.in_proj_bias).chunk(3, dim=-1)
+        else:
+            # The positional embedding is only added to the queries and keys.
+            q, k = F.linear(
+                with_pos_embed(x, pos_embed), self.in_proj_weight[: 2 * dim], self.in_proj_bias[: 2 * dim]
+            ).chunk(2, dim=-1)
+            v = F.linear(x, self.in_proj_weight[2 * dim :], self.in_proj_bias[2 * dim :])
+        # (B, T, D) -> (B, n_heads, T, head_dim)
+        q, k, v = (y.reshape(batch_size, seq_len, self.n_heads, -1).transpose(1, 2) for y in (q, k, v))
+        out = F.scaled_dot_product_attention(q, k, v, dropout_p=self.dropout if self.training else 0.0)
+        # (B, n_heads, T, head_dim) -> (B, T, D)
+        out = out.transpose(1, 2).reshape(batch_size, seq_len, dim)
+        return self.out_proj(out)
 
 
 class DiTDecoderLayer(nn.Module):
+    # Pre-fusion checkpoints stored one linear per modulation. They are listed in the order in which their
+    # outputs are laid out in `adaLN_modulation`: (shift1, scale1, gate1, shift2, scale2, gate2).
+    _legacy_modulations = (
+        "attn_mod1.shift",
+        "attn_mod1.scale",
+        "attn_mod2.scale",
+        "mlp_mod1.shift",
+        "mlp_mod1.scale",
+        "mlp_mod2.scale",
+    )
+
     def __init__(self, config: DiTConfig):
         super().__init__()
-        self.self_attn = nn.MultiheadAttention(config.dim_model, config.n_heads, dropout=config.dropout)
+        self.self_attn = DiTAttention(config.dim_model, config.n_heads, dropout=config.dropout)
         # Implementation of Feedforward model
         self.linear1 = nn.Linear(config.dim_model, config.dim_feedforward)
         self.linear2 = nn.Linear(config.dim_feedforward, config.dim_model)
@@ -531,33 +844,45 @@ class DiTDecoderLayer(nn.Module):
 
         self.activation = get_activation_fn(config.feedforward_activation)
 
-        # create modulation layers
-        self.attn_mod1 = ShiftScaleMod(config.dim_model)
-        self.attn_mod2 = ZeroScaleMod(config.dim_model)
-        self.mlp_mod1 = ShiftScaleMod(config.dim_model)
-        self.mlp_mod2 = ZeroScaleMod(config.dim_model)
+        # create modulation layers: all six shift/scale/gate vectors come out of a single projection of the
+        # conditioning vector
+        self.adaLN_modulation = nn.Sequential(
+            nn.SiLU(), nn.Linear(config.dim_model, 6 * config.dim_model, bias=True)
+        )
 
-    def forward(self, x, t, cond):
-        # process the conditioning vector first
-        cond = torch.mean(cond, axis=0)
-        cond = cond + t
+    def forward(self, x, cond):
+        shift1, scale1, gate1, shift2, scale2, gate2 = self.adaLN_modulation(cond)[:, None].chunk(6, dim=-1)
 
-        x2 = self.attn_mod1(self.norm1(x), cond)
-        x2, _ = self.self_attn(x2, x2, x2, need_weights=False)
-        x = self.attn_mod2(self.dropout1(x2), cond) + x
+        x2 = modulate(self.norm1(x), shift1, scale1)
+        x2 = self.self_attn(x2)
+        x = torch.addcmul(x, gate1, self.dropout1(x2))
 
-        x2 = self.mlp_mod1(self.norm2(x), cond)
+        x2 = modulate(self.norm2(x), shift2, scale2)
         x2 = self.linear2(self.dropout2(self.activation(self.linear1(x2))))
-        x2 = self.mlp_mod2(self.dropout3(x2), cond)
-        return x + x2
+        return torch.addcmul(x, gate2, self.dropout3(x2))
 
     def reset_parameters(self):
         for p in self.parameters():
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-        for s in (self.attn_mod1, self.attn_mod2, self.mlp_mod1, self.mlp_mod2):
-            s.reset_parameters()
+        # shift/scale projections are xavier initialized, gates are zero initialized
+        modulation = self.adaLN_modulation[1]
+        for i, weight in enumerate(modulation.weight.data.chunk(6)):
+            if i % 3 == 2:
+                nn.init.zeros_(weight)
+            else:
+                nn.init.xavier_uniform_(weight)
+        nn.init.zeros_(modulation.bias)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Fuse the per-modulation linears of older checkpoints into `adaLN_modulation`.
+        if prefix + self._legacy_modulations[0] + ".weight" in state_dict:
+            for name in ("weight", "bias"):
+                state_dict[f"{prefix}adaLN_modulation.1.{name}"] = torch.cat(
+                    [state_dict.pop(f"{prefix}{mod}.{name}") for mod in self._legacy_modulations]
+                )
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class DiTDecoder(nn.Module):
@@ -568,10 +893,13 @@ class DiTDecoder(nn.Module):
         self.layers = nn.ModuleList([DiTDecoderLayer(config) for _ in range(num_layers)])
         for layer in self.layers:
             layer.reset_parameters()
+            if config.use_torch_compile:
+                # Compiled in place (rather than wrapped) so that state dict keys are unchanged.
+                layer.compile(fullgraph=True, dynamic=True)
     
-    def forward(self, x: Tensor, time_embed: Tensor | None, encoder_out: Tensor) -> Tensor:
+    def forward(self, x: Tensor, cond: Tensor) -> Tensor:
         for layer in self.layers:
-            x = layer(x, t=time_embed, cond=encoder_out)
+            x = layer(x, cond=cond)
         return x
 
 
@@ -837,6 +1165,11 @@ def get_activation_fn(activation):
 def with_pos_embed(tensor, pos=None):
     return tensor if pos is None else tensor + pos
 
+
+def modulate(x: Tensor, shift: Tensor, scale: Tensor) -> Tensor:
+    """Compute `x * scale + shift` with a single fused multiply-add kernel."""
+    return torch.addcmul(shift, x, scale)
+
 class PositionalEncoding(nn.Module):
     def __init__(self, d_model, max_len=5000):
         super().__init__()
@@ -849,20 +1182,19 @@ class PositionalEncoding(nn.Module):
         )
         pe[:, 0::2] = torch.sin(position * div_term)
         pe[:, 1::2] = torch.cos(position * div_term)
-        pe = pe.unsqueeze(0).transpose(0, 1)
+        pe = pe.unsqueeze(1)  # (max_len, 1, d_model)
         self.register_buffer("pe", pe)
 
     def forward(self, x):
         """
         Args:
-            x: Tensor of shape (seq_len, batch_size, d_model)
+            x: Tensor of shape (batch_size, seq_len, d_model)
 
         Returns:
-            Tensor of shape (seq_len, batch_size, d_model) with positional encodings added
+            Positional encodings of shape (batch_size, seq_len, d_model). This is an expanded view of the
+            buffer, so it must not be modified in place.
         """
-        pe = self.pe[: x.shape[0]]
-        pe = pe.repeat((1, x.shape[1], 1))
-        return pe.detach().clone()
+        return self.pe[: x.shape[1]].transpose(0, 1).expand(x.shape[0], -1, -1)
 
 
 class TimeNetwork(nn.Module):
@@ -882,7 +1214,17 @@ class TimeNetwork(nn.Module):
     def forward(self, x):
         assert len(x.shape) == 1, "assumes 1d input timestep array"
         x = x[:, None] * self.w[None]
-        x = torch.cat((torch.cos(x), torch.sin(x)), dim=1)
+        if x.requires_grad or torch.compiler.is_compiling():
+            # `out=` doesn't support autograd (only needed when `w` is learnable), and Inductor fuses the
+            # concatenation on its own.
+            x = torch.cat((torch.cos(x), torch.sin(x)), dim=1)
+        else:
+            # Write cos and sin straight into the two halves of the embedding rather than concatenating.
+            half_dim = x.shape[1]
+            emb = x.new_empty(x.shape[0], 2 * half_dim)
+            torch.cos(x, out=emb[:, :half_dim])
+            torch.sin(x, out=emb[:, half_dim:])
+            x = emb
         return self.out_net(x)
 
 
@@ -895,15 +1237,10 @@ class FinalLayer(nn.Module):
             nn.SiLU(), nn.Linear(hidden_size, 2 * hidden_size, bias=True)
         )
 
-    def forward(self, x, t, cond):
-        # process the conditioning vector first
-        cond = torch.mean(cond, axis=0)
-        cond = cond + t
-
-        shift, scale = self.adaLN_modulation(cond).chunk(2, dim=1)
-        x = x * scale[None] + shift[None]
-        x = self.linear(x)
-        return x.transpose(0, 1)
+    def forward(self, x, cond):
+        shift, scale = self.adaLN_modulation(cond)[:, None].chunk(2, dim=-1)
+        x = modulate(x, shift, scale)
+        return self.linear(x)
 
     def reset_parameters(self):
         for p in self.parameters():
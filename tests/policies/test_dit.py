@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+
+# Copyright 2024 The HuggingFace Inc. team. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import pytest
+import torch
+import torch.nn.functional as F  # noqa: N812
+from torch import nn
+
+from lerobot.common.policies.dit.configuration_dit import DiTConfig
+from lerobot.common.policies.dit.modeling_dit import (
+    DiT,
+    DiTPolicy,
+    _make_fast_step,
+    _make_noise_scheduler,
+)
+from lerobot.configs.types import FeatureType, PolicyFeature
+from tests.utils import require_cuda
+
+
+def make_dit_config(**kwargs) -> DiTConfig:
+    """A small DiT configuration with a state input and one camera."""
+    kwargs = {
+        "device": "cpu",
+        "crop_shape": None,
+        "n_heads": 4,
+        "dim_feedforward": 128,
+        "n_encoder_layers": 2,
+        "n_decoder_layers": 2,
+        "num_inference_steps": 5,
+        **kwargs,
+    }
+    config = DiTConfig(**kwargs)
+    config.input_features = {
+        "observation.state": PolicyFeature(FeatureType.STATE, (4,)),
+        "observation.images.top": PolicyFeature(FeatureType.VISUAL, (3, 32, 32)),
+    }
+    config.output_features = {"action": PolicyFeature(FeatureType.ACTION, (3,))}
+    return config
+
+
+def make_dit_stats() -> dict[str, dict[str, torch.Tensor]]:
+    def stats(shape):
+        return {
+            "mean": torch.zeros(shape),
+            "std": torch.ones(shape),
+            "min": torch.zeros(shape),
+            "max": torch.ones(shape),
+        }
+
+    return {"observation.state": stats(4), "observation.images.top": stats((3, 1, 1)), "action": stats(3)}
+
+
+def make_dit_batch(config: DiTConfig, batch_size: int = 2) -> dict[str, torch.Tensor]:
+    return {
+        "observation.state": torch.rand(batch_size, config.n_obs_steps, 4),
+        "observation.images": torch.rand(batch_size, config.n_obs_steps, 1, 3, 32, 32),
+        "action": torch.rand(batch_size, config.horizon, 3),
+        "action_is_pad": torch.zeros(batch_size, config.horizon, dtype=torch.bool),
+    }
+
+
+@pytest.mark.parametrize("noise_scheduler_type", ["DDIM", "DDPM"])
+@pytest.mark.parametrize("prediction_type", ["epsilon", "sample"])
+def test_dit_fast_step_matches_scheduler_step(noise_scheduler_type: str, prediction_type: str):
+    """Check that the precomputed step coefficients reproduce `scheduler.step` over a full denoising loop."""
+    scheduler = _make_noise_scheduler(
+        noise_scheduler_type,
+        num_train_timesteps=100,
+        beta_start=0.0001,
+        beta_end=0.02,
+        beta_schedule="squaredcos_cap_v2",
+        clip_sample=True,
+        prediction_type=prediction_type,
+    )
+    scheduler.set_timesteps(10)
+    fast_step = _make_fast_step(scheduler, torch.device("cpu"), torch.float32)
+
+    torch.manual_seed(0)
+    sample = torch.randn(2, 16, 3)
+    model_outputs = torch.randn(len(scheduler.timesteps), 2, 16, 3)
+    generator = torch.Generator().manual_seed(1)
+    fast_generator = torch.Generator().manual_seed(1)
+    fast_sample = sample.clone()
+    for i, t in enumerate(scheduler.timesteps):
+        sample = scheduler.step(model_outputs[i], t, sample, generator=generator).prev_sample
+        fast_sample = fast_step(model_outputs[i], i, fast_sample, generator=fast_generator)
+        torch.testing.assert_close(fast_sample, sample, rtol=1e-4, atol=1e-5)
+
+
+def test_dit_compute_loss_accumulation():
+    """Several losses can be computed before a single backward pass (e.g. for gradient accumulation)."""
+    config = make_dit_config()
+    model = DiT(config)
+    batch = make_dit_batch(config)
+    loss = model.compute_loss(batch) + model.compute_loss(batch)
+    loss.backward()
+
+
+@pytest.mark.parametrize("use_spatial_softmax", [False, True])
+def test_dit_quantize_vision_backbone(use_spatial_softmax: bool):
+    """The ResNet convolutions are quantized to int8 and the features stay close to the float ones."""
+    config = make_dit_config(quantize_vision_backbone=True, use_spatial_softmax=use_spatial_softmax)
+    policy = DiTPolicy(config, make_dit_stats())
+    policy.eval()
+    calibration_batches = [
+        {
+            "observation.state": torch.rand(4, config.n_obs_steps, 4),
+            "observation.images.top": torch.rand(4, config.n_obs_steps, 3, 32, 32),
+        }
+        for _ in range(4)
+    ]
+    images = torch.rand(4, 3, 32, 32)
+    with torch.no_grad():
+        expected = policy.diffusion.rgb_encoder[0](images)
+
+    with pytest.raises(ValueError):
+        policy.convert_for_inference()
+    policy.convert_for_inference(calibration_batches)
+
+    n_quantized = sum(
+        isinstance(module, torch.ao.nn.quantized.Conv2d) for module in policy.diffusion.rgb_encoder.modules()
+    )
+    assert n_quantized == 20  # all the convolutions of the ResNet18
+    with torch.no_grad():
+        features = policy.diffusion.rgb_encoder[0](images)
+    assert features.shape == expected.shape
+    assert (features - expected).abs().mean() < 0.1 * expected.abs().mean()
+    with torch.no_grad():
+        policy.select_action({"observation.state": torch.rand(4, 4), "observation.images.top": images})
+
+
+def test_dit_torch_compile():
+    """The compiled layers can be trained and sampled from, and sample like the eager ones."""
+    config = make_dit_config(use_torch_compile=True)
+    policy = DiTPolicy(config, make_dit_stats())
+    batch = make_dit_batch(config)
+    batch["observation.images.top"] = batch.pop("observation.images")[:, :, 0]
+    loss, _ = policy.forward(batch)
+    loss.backward()
+
+    policy.eval()
+    eager_policy = DiTPolicy(make_dit_config(), make_dit_stats())
+    eager_policy.load_state_dict(policy.state_dict())
+    eager_policy.eval()
+    observation = {"observation.state": torch.rand(2, 4), "observation.images.top": torch.rand(2, 3, 32, 32)}
+    torch.manual_seed(0)
+    actual = policy.select_action(observation)
+    torch.manual_seed(0)
+    expected = eager_policy.select_action(observation)
+    torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+
+
+@require_cuda
+@pytest.mark.parametrize("use_cuda_graph", [False, True])
+def test_dit_torch_compile_matches_eager_cuda(use_cuda_graph: bool):
+    """The compiled layers give the same samples as the eager ones on CUDA, also inside a CUDA graph."""
+    config = make_dit_config(device="cuda", use_torch_compile=True, use_cuda_graph=use_cuda_graph)
+    model = DiT(config).to("cuda").eval()
+    eager_model = DiT(make_dit_config(device="cuda")).to("cuda").eval()
+    eager_model.load_state_dict(model.state_dict())
+    global_cond = torch.randn(3, 4, config.dim_model, device="cuda")
+    with torch.no_grad():
+        expected = eager_model.conditional_sample(
+            3, global_cond, generator=torch.Generator("cuda").manual_seed(0)
+        )
+        for _ in range(2):
+            actual = model.conditional_sample(
+                3, global_cond, generator=torch.Generator("cuda").manual_seed(0)
+            )
+            torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+
+
+@require_cuda
+@pytest.mark.parametrize("legacy_final_layer_cond", [True, False])
+def test_dit_cuda_graph_matches_eager(legacy_final_layer_cond: bool):
+    """Replaying the pooled CUDA graphs (with a padded batch) gives the same samples as the eager model."""
+    config = make_dit_config(device="cuda", legacy_final_layer_cond=legacy_final_layer_cond)
+    model = DiT(config).to("cuda").eval()
+    global_cond = torch.randn(3, 4, config.dim_model, device="cuda")
+    with torch.no_grad():
+        expected = model.conditional_sample(3, global_cond, generator=torch.Generator("cuda").manual_seed(0))
+        config.use_cuda_graph = True
+        for _ in range(2):  # capture, then replay from the pool
+            actual = model.conditional_sample(
+                3, global_cond, generator=torch.Generator("cuda").manual_seed(0)
+            )
+            torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+
+        # Moving the parameters invalidates the captured graphs.
+        model.to("cpu").to("cuda")
+        assert not model._graph_pool
+        actual = model.conditional_sample(3, global_cond, generator=torch.Generator("cuda").manual_seed(0))
+        torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-4)
+
+
+def legacy_noise_net_forward(
+    state_dict: dict[str, torch.Tensor],
+    config: DiTConfig,
+    noise_actions: torch.Tensor,
+    global_cond: torch.Tensor,
+    time_enc: torch.Tensor,
+) -> torch.Tensor:
+    """Reference forward pass of the original noise network (with its checkpoint layout) in eval mode.
+
+    The tokens are kept sequence first, the attention is `nn.MultiheadAttention` and the decoder layers are
+    modulated by one linear layer per shift/scale.
+    """
+    dim = config.dim_model
+
+    def linear(x, name):
+        return F.linear(x, state_dict[f"{name}.weight"], state_dict[f"{name}.bias"])
+
+    def layer_norm(x, name):
+        return F.layer_norm(x, (dim,), state_dict[f"{name}.weight"], state_dict[f"{name}.bias"])
+
+    def attention(q, k, v, name):
+        attn = nn.MultiheadAttention(dim, config.n_heads).eval()
+        attn.load_state_dict(
+            {
+                key: state_dict[f"{name}.{key}"]
+                for key in ["in_proj_weight", "in_proj_bias", "out_proj.weight", "out_proj.bias"]
+            }
+        )
+        return attn(q, k, v, need_weights=False)[0]
+
+    def mlp(x, name):
+        return linear(F.gelu(linear(x, f"{name}.linear1"), approximate="tanh"), f"{name}.linear2")
+
+    # Encoder.
+    src = global_cond.transpose(0, 1)
+    pos = state_dict["noise_net.enc_pos.pe"][: src.shape[0]]
+    for i in range(config.n_encoder_layers):
+        name = f"noise_net.encoder.layers.{i}"
+        src = layer_norm(src + attention(src + pos, src + pos, src, f"{name}.self_attn"), f"{name}.norm1")
+        src = layer_norm(src + mlp(src, name), f"{name}.norm2")
+    enc_cache = src
+
+    # Decoder.
+    ac_tokens = F.gelu(linear(noise_actions, "noise_net.ac_proj.0"), approximate="tanh")
+    x = linear(ac_tokens, "noise_net.ac_proj.2").transpose(0, 1) + state_dict["noise_net.dec_pos"]
+    cond = F.silu(enc_cache.mean(dim=0) + time_enc)
+    for i in range(config.n_encoder_layers):
+        name = f"noise_net.decoder.layers.{i}"
+
+        def modulate(x, mod, cond=cond, name=name):
+            return x * linear(cond, f"{name}.{mod}.scale")[None] + linear(cond, f"{name}.{mod}.shift")[None]
+
+        x2 = modulate(layer_norm(x, f"{name}.norm1"), "attn_mod1")
+        x = x + attention(x2, x2, x2, f"{name}.self_attn") * linear(cond, f"{name}.attn_mod2.scale")[None]
+        x2 = mlp(modulate(layer_norm(x, f"{name}.norm2"), "mlp_mod1"), name)
+        x = x + x2 * linear(cond, f"{name}.mlp_mod2.scale")[None]
+
+    # The final layer is conditioned on the last encoder token averaged over the batch.
+    final_cond = F.silu(enc_cache[-1].mean(dim=0) + time_enc)
+    shift, scale = linear(final_cond, "noise_net.eps_out.adaLN_modulation.1").chunk(2, dim=1)
+    x = linear(x * scale[None] + shift[None], "noise_net.eps_out.linear")
+    return x.transpose(0, 1)
+
+
+def test_dit_load_legacy_state_dict():
+    """Checkpoints in the original layout load and give the same outputs as the original noise network."""
+    config = make_dit_config()
+    model = DiT(config).eval()
+    dim = config.dim_model
+
+    # Build a checkpoint in the original layout, with random weights so that no zero-initialized layer hides
+    # a mismatch.
+    legacy_state_dict = {}
+    for key, value in model.state_dict().items():
+        if ".decoder.layers." in key and ".adaLN_modulation." in key:
+            continue
+        legacy_state_dict[key] = (
+            value + 0.05 * torch.randn_like(value) if value.is_floating_point() else value
+        )
+    legacy_state_dict["noise_net.enc_pos.pe"] = model.state_dict()["noise_net.enc_pos.pe"]
+    legacy_state_dict["noise_net.dec_pos"] = torch.randn(config.horizon, 1, dim)
+    for i in range(config.n_encoder_layers):
+        for modulation in ["attn_mod1.shift", "attn_mod1.scale", "attn_mod2.scale"]:
+            for mod in [modulation, modulation.replace("attn", "mlp")]:
+                legacy_state_dict[f"noise_net.decoder.layers.{i}.{mod}.weight"] = 0.05 * torch.randn(dim, dim)
+                legacy_state_dict[f"noise_net.decoder.layers.{i}.{mod}.bias"] = 0.05 * torch.randn(dim)
+    model.load_state_dict(legacy_state_dict)
+
+    noise_actions = torch.randn(2, config.horizon, 3)
+    global_cond = torch.randn(2, 4, dim)
+    time_enc = torch.randn(2, dim)
+    with torch.no_grad():
+        expected = legacy_noise_net_forward(legacy_state_dict, config, noise_actions, global_cond, time_enc)
+        enc_cache = model.noise_net.forward_enc(global_cond)
+        actual = model.noise_net.forward_dec(noise_actions, None, enc_cache, time_enc=time_enc)
+    torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-5)